@@ -0,0 +1,174 @@
+import asyncio
+from telegram import Update
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from formatters import format_flight_results
+
+
+# Static replies, built once at import
+_START_MSG = (
+    "Hi! Tell me where you want to fly, and I'll help you find the cheapest tickets!\n\n"
+    "Example: \"Find me flights from Toronto to New York on March 10, returning March 15\""
+)
+
+_UNPARSED_MSG = (
+    "Sorry, I couldn't understand that. Please tell me:\n"
+    "• Where you're flying from\n"
+    "• Where you're flying to\n"
+    "• When you want to depart\n"
+    "• When you want to return (optional)"
+)
+
+_SEARCHING_MSG = (
+    "🔎 Searching for flights with deep search enabled...\n"
+    "This gives results identical to Google Flights in the browser."
+)
+
+_BUSY_MSG = "Still searching your last request..."
+
+_CANCEL_MSG = "Search cancelled. Send me a new flight request anytime!"
+
+_HELP_MSG = (
+    "🤖 *Flight Search Bot Commands*\n\n"
+    "/start - Start a new conversation\n"
+    "/cancel - Cancel current search\n"
+    "/help - Show this help message\n\n"
+    "*How to search for flights:*\n"
+    "Just describe your trip in natural language!\n\n"
+    "*Examples:*\n"
+    "• _Find flights from Toronto to New York on March 10_\n"
+    "• _I want to fly from LAX to JFK, leaving April 5 and returning April 12_\n"
+    "• _Show me flights from London to Paris next Monday_"
+)
+
+
+def _reset_conversation(context):
+    """
+    Forgets everything collected for this user except the in-flight search marker, so /start and
+    /cancel during a search can't let a second one start alongside it.
+    """
+    busy = context.user_data.get('_busy')
+    context.user_data.clear()
+    if busy:
+        context.user_data['_busy'] = busy
+
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    _reset_conversation(context)
+    await update.message.reply_text(_START_MSG)
+
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Drop messages that arrive while this user's previous search is still running
+    if context.user_data.get('_busy'):
+        await update.message.reply_text(_BUSY_MSG)
+        return
+    
+    context.user_data['_busy'] = True
+    try:
+        await _handle_flight_request(update, context)
+    finally:
+        context.user_data.pop('_busy', None)
+
+
+async def _handle_flight_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_input = update.message.text
+    
+    # The Gemini SDK call is blocking, so keep it off the event loop
+    extract_fn = context.bot_data['extract_fn']
+    structured = await asyncio.get_running_loop().run_in_executor(None, extract_fn, user_input)
+    
+    if not structured:
+        await update.message.reply_text(_UNPARSED_MSG)
+        return
+    
+    # Merge newly extracted fields into what we already know. Falsy values (None, "", default 0 counts)
+    # are skipped so a follow-up message can't wipe out details from an earlier one.
+    context.user_data.setdefault('flight_data', {}).update(
+        {key: value for key, value in structured.items() if value and value != "null"}
+    )
+    
+    validate_fn = context.bot_data['validate_fn']
+    is_valid, missing_fields, message = validate_fn(context.user_data['flight_data'])
+    
+    if not is_valid:
+        await update.message.reply_text(message)
+        return
+    
+    status_message = await update.message.reply_text(context.bot_data['searching_msg'])
+    
+    try:
+        flight_data = context.user_data['flight_data']
+        search_fn = context.bot_data['search_fn']
+        results = await search_fn(
+            departure=flight_data['departure'],
+            destination=flight_data['destination'],
+            depart_date=flight_data['depart_date'],
+            return_date=flight_data.get('return_date'),
+            adults=flight_data.get('adults', 1),
+            children=flight_data.get('children', 0)
+        )
+        
+        format_fn = context.bot_data['format_fn']
+        response = format_fn(results, flight_data)
+        # Replace the "Searching..." message with the results instead of sending a second one
+        await context.bot.edit_message_text(
+            chat_id=status_message.chat_id,
+            message_id=status_message.message_id,
+            text=response,
+            parse_mode='Markdown'
+        )
+        
+        _reset_conversation(context)
+        
+    except Exception as e:
+        await context.bot.edit_message_text(
+            chat_id=status_message.chat_id,
+            message_id=status_message.message_id,
+            text=f"Sorry, I encountered an error while searching for flights: {str(e)}\n\n"
+                 "Please try again with a different search."
+        )
+        _reset_conversation(context)
+
+
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    _reset_conversation(context)
+    await update.message.reply_text(_CANCEL_MSG)
+
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(_HELP_MSG, parse_mode='Markdown')
+
+
+def build_app(token, search_fn, extract_fn, validate_fn, format_fn=format_flight_results,
+              searching_msg=_SEARCHING_MSG, post_shutdown=None):
+    """
+    Builds the Telegram application with the generic handlers wired to a flight backend.
+    
+    Args:
+        search_fn: async callable taking departure, destination, depart_date, return_date, adults, children,
+            returning results that format_fn understands
+        extract_fn: callable turning user text into a flight details dict (or None)
+        validate_fn: callable returning (is_valid, missing_fields, message) for a flight details dict
+        format_fn: callable turning search_fn's results and the flight details into the Markdown reply.
+            The default expects the SerpAPI results dict; other backends must pass their own.
+        searching_msg: text shown while the search runs (the default describes SerpAPI deep search)
+        post_shutdown: optional async callable run with the application on shutdown (e.g. closing HTTP sessions)
+    """
+    # Process updates concurrently so one user's search doesn't block everyone else
+    builder = Application.builder().token(token).concurrent_updates(True)
+    if post_shutdown:
+        builder = builder.post_shutdown(post_shutdown)
+    app = builder.build()
+    app.bot_data.update(
+        search_fn=search_fn,
+        extract_fn=extract_fn,
+        validate_fn=validate_fn,
+        format_fn=format_fn,
+        searching_msg=searching_msg
+    )
+    
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("cancel", cancel))
+    app.add_handler(CommandHandler("help", help_command))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    return app
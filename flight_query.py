@@ -5,10 +5,11 @@ from dotenv import load_dotenv
 from fast_flights import FlightData, Passengers, get_flights
 import json
 import re
-from datetime import datetime
+from datetime import date, datetime
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
-from threading import Thread
+from threading import Lock, Thread
+from collections import OrderedDict
 
 load_dotenv()
 
@@ -20,14 +21,59 @@ if not GEMINI_API_KEY:
 genai.configure(api_key=GEMINI_API_KEY)
 model = genai.GenerativeModel('gemini-2.0-flash')
 
-def extract_flight_details(user_input):
+# Dedicated pool for blocking flight scrapes, kept separate from the loop's default executor
+_FLIGHT_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="flight")
+
+_QUERY_PUNCT_RE = re.compile(r"[^\w\s'/:>-]")
+_QUERY_SPACE_RE = re.compile(r'\s+')
+
+
+def _normalize_query(user_input):
     """
-    Uses Gemini API to extract structured flight query details from natural language input.
-    Returns a dictionary with flight details or None if parsing fails.
+    Lowercases, drops punctuation and collapses whitespace so equivalent queries share a cache entry.
+    Apostrophes and date/route separators (-, /, :, >) are kept since they carry meaning.
+    Only used as the cache key; Gemini is always sent the user's original text.
     """
-    try:
-        response = model.generate_content(
-            contents=[f"""You are a flight booking assistant. Extract flight details from this query and return ONLY valid JSON, nothing else.
+    text = _QUERY_PUNCT_RE.sub(' ', user_input.lower())
+    return _QUERY_SPACE_RE.sub(' ', text).strip()
+
+
+# Extraction results keyed by (today, normalized query). The date is part of the key because
+# relative inputs like "tomorrow" mean a different date each day.
+_EXTRACTION_CACHE = OrderedDict()
+_EXTRACTION_CACHE_SIZE = 1024
+_EXTRACTION_CACHE_LOCK = Lock()  # extraction runs in executor threads
+
+
+def _get_cached_details(key):
+    """
+    Returns cached extraction results for a key, marking them recently used, or None.
+    """
+    with _EXTRACTION_CACHE_LOCK:
+        details = _EXTRACTION_CACHE.get(key)
+        if details is not None:
+            _EXTRACTION_CACHE.move_to_end(key)
+        return details
+
+
+def _cache_details(key, details):
+    """
+    Stores extraction results, evicting the least recently used entry once the cache is full.
+    """
+    with _EXTRACTION_CACHE_LOCK:
+        _EXTRACTION_CACHE[key] = details
+        _EXTRACTION_CACHE.move_to_end(key)
+        if len(_EXTRACTION_CACHE) > _EXTRACTION_CACHE_SIZE:
+            _EXTRACTION_CACHE.popitem(last=False)
+
+
+def _extract_flight_details_uncached(user_input):
+    """
+    Calls Gemini with the user's raw query.
+    Raises on failure so that errors are never cached.
+    """
+    response = model.generate_content(
+        contents=[f"""You are a flight booking assistant. Extract flight details from this query and return ONLY valid JSON, nothing else.
 
 Query: "{user_input}"
 
@@ -37,27 +83,43 @@ Return ONLY this JSON format (no markdown, no explanation):
 Example: {{"departure": "YYZ", "destination": "JFK", "depart_date": "2025-03-10", "return_date": "2025-03-15", "adults": 1, "children": 0}}
 """])
 
-        text = response.text.strip()
-        
-        print(f"DEBUG - Raw response: '{text}'")
+    text = response.text.strip()
+    
+    print(f"DEBUG - Raw response: '{text}'")
 
-                # Remove markdown code blocks if present
-        text = text.replace("`", "").strip()
-        if text.startswith("json"):
-            text = text[4:].strip()
+    # Remove markdown code blocks if present
+    text = text.replace("`", "").strip()
+    if text.startswith("json"):
+        text = text[4:].strip()
+    
+    print(f"DEBUG - After cleanup: '{text}'")
+    
+    flight_data = json.loads(text)
+    
+    print(f"DEBUG - Parsed successfully: {flight_data}")
+    
+    return flight_data
 
-        
-        print(f"DEBUG - After cleanup: '{text}'")
-        
-        flight_data = json.loads(text)
-        
-        print(f"DEBUG - Parsed successfully: {flight_data}")
-        
-        return flight_data
+
+def extract_flight_details(user_input):
+    """
+    Uses Gemini API to extract structured flight query details from natural language input.
+    Returns a dictionary with flight details or None if parsing fails.
+    Results are cached per day by normalized query, so repeated inputs skip the Gemini call.
+    """
+    try:
+        key = (date.today(), _normalize_query(user_input))
+        details = _get_cached_details(key)
+        if details is None:
+            # Gemini sees what the user actually typed; normalization only shapes the cache key
+            details = _extract_flight_details_uncached(user_input)
+            _cache_details(key, details)
+        # Copy so callers can't mutate the cached entry
+        return dict(details)
     
     except json.JSONDecodeError as e:
         print(f"JSON parsing error: {e}")
-        print(f"Text that failed to parse: '{text}'")
+        print(f"Text that failed to parse: '{e.doc}'")
         return None
     except Exception as e:
         print(f"Error extracting flight details: {e}")
@@ -140,9 +202,19 @@ def _get_flights_in_thread(flight_data, trip_type, seat, passengers):
         raise
 
 
+def _merge_round_trip(outbound, inbound):
+    """
+    Combines two one-way results into a single round-trip result.
+    Outbound options stay in `flights`; return options are attached as `return_flights`.
+    """
+    outbound.return_flights = inbound.flights if inbound else []
+    return outbound
+
+
 async def search_flights_fastflights(departure, destination, depart_date, return_date=None, adults=1, children=0):
     """
     Searches for flights using the fast_flights library with LOCAL mode.
+    Round trips are searched as two concurrent one-way lookups.
     """
     # Normalize airport codes
     departure = normalize_airport_code(departure)
@@ -151,12 +223,11 @@ async def search_flights_fastflights(departure, destination, depart_date, return
     if not departure or not destination:
         raise ValueError("Invalid airport codes provided")
     
-    flight_data = [FlightData(date=depart_date, from_airport=departure, to_airport=destination)]
-    trip_type = "one-way"
+    outbound_leg = [FlightData(date=depart_date, from_airport=departure, to_airport=destination)]
+    return_leg = None
     
     if return_date and return_date != "null":
-        flight_data.append(FlightData(date=return_date, from_airport=destination, to_airport=departure))
-        trip_type = "round-trip"
+        return_leg = [FlightData(date=return_date, from_airport=destination, to_airport=departure)]
     
     passengers = Passengers(
         adults=int(adults) if adults else 1,
@@ -169,15 +240,24 @@ async def search_flights_fastflights(departure, destination, depart_date, return
         print("Searching for flights (this may take 10-15 seconds for complete results)...")
         
         # Run in thread pool executor
-        loop = asyncio.get_event_loop()
-        results = await loop.run_in_executor(
-            None,
-            _get_flights_in_thread,
-            flight_data,
-            trip_type,
-            "economy",
-            passengers
-        )
+        loop = asyncio.get_running_loop()
+        
+        def run_leg(leg):
+            return loop.run_in_executor(
+                _FLIGHT_POOL,
+                _get_flights_in_thread,
+                leg,
+                "one-way",
+                "economy",
+                passengers
+            )
+        
+        if return_leg:
+            # Both legs are independent one-way searches, so fetch them concurrently
+            outbound, inbound = await asyncio.gather(run_leg(outbound_leg), run_leg(return_leg))
+            return _merge_round_trip(outbound, inbound)
+        
+        results = await run_leg(outbound_leg)
         
         return results
     
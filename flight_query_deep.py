@@ -2,11 +2,17 @@ import os
 import google.generativeai as genai
 from dotenv import load_dotenv
 from fast_flights import FlightData, Passengers, get_flights
+import fast_flights.core
+from primp import Client
 import json
 import re
-from datetime import datetime
+from datetime import date, datetime
 import asyncio
+import heapq
+import time
 from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from threading import Lock
 
 load_dotenv()
 
@@ -18,6 +24,53 @@ if not GEMINI_API_KEY:
 genai.configure(api_key=GEMINI_API_KEY)
 model = genai.GenerativeModel('gemini-2.0-flash')
 
+# Dedicated pool for blocking flight scrapes, kept separate from the loop's default executor
+_FLIGHT_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="flight")
+
+# Compiled once at import and reused on every request
+_IATA_RE = re.compile(r'^[A-Z]{3}$')
+_QUERY_PUNCT_RE = re.compile(r"[^\w\s'/:>-]")
+_QUERY_SPACE_RE = re.compile(r'\s+')
+_PRICE_RE = re.compile(r'\d[\d,]*(?:\.\d+)?')
+
+# Ask Gemini for raw JSON matching this schema, so no markdown cleanup is needed
+_EXTRACTION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "object",
+        "properties": {
+            "departure": {"type": "string"},
+            "destination": {"type": "string"},
+            "depart_date": {"type": "string"},
+            "return_date": {"type": "string", "nullable": True},
+            "adults": {"type": "integer"},
+            "children": {"type": "integer"}
+        }
+    }
+}
+
+# "local" drives a headless browser; "common"/"fallback" go over plain HTTP and use the pooled client below
+FETCH_MODE = os.environ.get('FAST_FLIGHTS_FETCH_MODE', 'local')
+
+# fast_flights opens a new client (fresh TCP+TLS handshake) per request; share one keep-alive client instead.
+# Only the HTTP fetch modes call fetch, so "local" leaves fast_flights untouched.
+_HTTP_CLIENT = None
+
+
+def _pooled_fetch(params):
+    """
+    Drop-in replacement for fast_flights.core.fetch that reuses the module-level client.
+    """
+    res = _HTTP_CLIENT.get("https://www.google.com/travel/flights", params=params)
+    assert res.status_code == 200, f"{res.status_code} Result: {res.text_markdown}"
+    return res
+
+
+if FETCH_MODE != 'local':
+    # Same client settings as upstream's fetch (it also disables verification)
+    _HTTP_CLIENT = Client(impersonate="chrome_126", verify=False)
+    fast_flights.core.fetch = _pooled_fetch
+
 
 def _get_flights_in_thread(flight_data, trip_type, seat, passengers):
     """
@@ -29,7 +82,7 @@ def _get_flights_in_thread(flight_data, trip_type, seat, passengers):
             trip=trip_type,
             seat=seat,
             passengers=passengers,
-            fetch_mode="local"
+            fetch_mode=FETCH_MODE
         )
         return results
     except Exception as e:
@@ -37,20 +90,33 @@ def _get_flights_in_thread(flight_data, trip_type, seat, passengers):
         raise
 
 
-def _deep_search_flights(flight_data, trip_type, seat, passengers, num_scrolls=3):
+def _price_value(price):
+    """
+    Converts a fast_flights price string (e.g. "$1,234", "CA$98") to a number.
+    Unparseable prices sort last.
+    """
+    digits = _PRICE_RE.search(price or "")
+    return float(digits.group().replace(",", "")) if digits else float('inf')
+
+
+def _deep_search_flights(flight_data, trip_type, seat, passengers, num_scrolls=3, top_k=5):
     """
     Performs a deep search by making multiple requests and aggregating results.
     This mimics SerpAPI's deep_search feature.
+    Only the top_k cheapest unique flights are kept, already sorted by price.
     
     Args:
         num_scrolls: Number of times to "scroll" through results (default 3)
+        top_k: Number of cheapest flights to keep (default 5)
     """
-    all_flights = []
+    # Bounded max-heap of (-price, -seq, flight): the root is the most expensive of the kept flights
+    top = []
     seen_flights = set()  # Track flights we've already seen
     
     try:
         for scroll in range(num_scrolls):
             print(f"Deep search iteration {scroll + 1}/{num_scrolls}...")
+            prev_len = len(seen_flights)
             
             # Make request
             results = get_flights(
@@ -58,30 +124,38 @@ def _deep_search_flights(flight_data, trip_type, seat, passengers, num_scrolls=3
                 trip=trip_type,
                 seat=seat,
                 passengers=passengers,
-                fetch_mode="local"
+                fetch_mode=FETCH_MODE
             )
             
             # Collect unique flights
             if results and hasattr(results, 'flights'):
                 for flight in results.flights:
                     # Create unique identifier for flight
-                    flight_id = f"{flight.name}_{flight.departure}_{flight.arrival}_{flight.price}"
+                    flight_id = (flight.name, flight.departure, flight.arrival, flight.price)
                     
                     if flight_id not in seen_flights:
                         seen_flights.add(flight_id)
-                        all_flights.append(flight)
+                        entry = (-_price_value(flight.price), -len(seen_flights), flight)
+                        if len(top) < top_k:
+                            heapq.heappush(top, entry)
+                        else:
+                            heapq.heappushpop(top, entry)
                 
-                print(f"Found {len(all_flights)} unique flights so far...")
+                print(f"Found {len(seen_flights)} unique flights so far...")
             
-            # Small delay between scrolls to let Google Flights update
+            # fast_flights has no scroll token, so a repeat request that adds nothing won't either
+            if len(seen_flights) == prev_len:
+                print("No new flights on this scroll, stopping deep search early")
+                break
+            
+            # Delay between scrolls to let Google Flights update; grows while new flights keep appearing
             if scroll < num_scrolls - 1:
-                import time
-                time.sleep(15)
+                time.sleep(min(15, 3 * (scroll + 1)))
         
-        # Return modified result object with all flights
+        # Return modified result object with the cheapest flights
         if results:
-            # Replace flights list with our aggregated list
-            results.flights = all_flights
+            # Replace flights list with our aggregated list, cheapest first
+            results.flights = [flight for _, _, flight in sorted(top, key=lambda entry: (-entry[0], -entry[1]))]
         
         return results
     
@@ -91,14 +165,52 @@ def _deep_search_flights(flight_data, trip_type, seat, passengers, num_scrolls=3
 
 
 # Keep all your existing functions from before
-def extract_flight_details(user_input):
+def _normalize_query(user_input):
     """
-    Uses Gemini API to extract structured flight query details from natural language input.
-    Returns a dictionary with flight details or None if parsing fails.
+    Lowercases, drops punctuation and collapses whitespace so equivalent queries share a cache entry.
+    Apostrophes and date/route separators (-, /, :, >) are kept since they carry meaning.
+    Only used as the cache key; Gemini is always sent the user's original text.
     """
-    try:
-        response = model.generate_content(
-            contents=[f"""You are a flight booking assistant. Extract flight details from this query and return ONLY valid JSON, nothing else.
+    text = _QUERY_PUNCT_RE.sub(' ', user_input.lower())
+    return _QUERY_SPACE_RE.sub(' ', text).strip()
+
+
+# Extraction results keyed by (today, normalized query). The date is part of the key because
+# relative inputs like "tomorrow" mean a different date each day.
+_EXTRACTION_CACHE = OrderedDict()
+_EXTRACTION_CACHE_SIZE = 1024
+_EXTRACTION_CACHE_LOCK = Lock()  # extraction runs in executor threads
+
+
+def _get_cached_details(key):
+    """
+    Returns cached extraction results for a key, marking them recently used, or None.
+    """
+    with _EXTRACTION_CACHE_LOCK:
+        details = _EXTRACTION_CACHE.get(key)
+        if details is not None:
+            _EXTRACTION_CACHE.move_to_end(key)
+        return details
+
+
+def _cache_details(key, details):
+    """
+    Stores extraction results, evicting the least recently used entry once the cache is full.
+    """
+    with _EXTRACTION_CACHE_LOCK:
+        _EXTRACTION_CACHE[key] = details
+        _EXTRACTION_CACHE.move_to_end(key)
+        if len(_EXTRACTION_CACHE) > _EXTRACTION_CACHE_SIZE:
+            _EXTRACTION_CACHE.popitem(last=False)
+
+
+def _extract_flight_details_uncached(user_input):
+    """
+    Calls Gemini with the user's raw query.
+    Raises on failure so that errors are never cached.
+    """
+    response = model.generate_content(
+        contents=[f"""You are a flight booking assistant. Extract flight details from this query and return ONLY valid JSON, nothing else.
 
 Query: "{user_input}"
 
@@ -106,28 +218,39 @@ Return ONLY this JSON format (no markdown, no explanation):
 {{"departure": "airport_code", "destination": "airport_code", "depart_date": "YYYY-MM-DD", "return_date": "YYYY-MM-DD or null", "adults": 1, "children": 0}}
 
 Example: {{"departure": "YYZ", "destination": "JFK", "depart_date": "2025-03-10", "return_date": "2025-03-15", "adults": 1, "children": 0}}
-"""])
+"""],
+        generation_config=_EXTRACTION_CONFIG)
 
-        text = response.text.strip()
-        
-        print(f"DEBUG - Raw response: '{text}'")
-        
-        # Remove markdown code blocks if present
-        text = text.replace(chr(96), "").strip()
-        if text.startswith("json"):
-            text = text[4:].strip()
-        
-        print(f"DEBUG - After cleanup: '{text}'")
-        
-        flight_data = json.loads(text)
-        
-        print(f"DEBUG - Parsed successfully: {flight_data}")
-        
-        return flight_data
+    text = response.text
+    
+    print(f"DEBUG - Raw response: '{text}'")
+    
+    flight_data = json.loads(text)
+    
+    print(f"DEBUG - Parsed successfully: {flight_data}")
+    
+    return flight_data
+
+
+def extract_flight_details(user_input):
+    """
+    Uses Gemini API to extract structured flight query details from natural language input.
+    Returns a dictionary with flight details or None if parsing fails.
+    Results are cached per day by normalized query, so repeated inputs skip the Gemini call.
+    """
+    try:
+        key = (date.today(), _normalize_query(user_input))
+        details = _get_cached_details(key)
+        if details is None:
+            # Gemini sees what the user actually typed; normalization only shapes the cache key
+            details = _extract_flight_details_uncached(user_input)
+            _cache_details(key, details)
+        # Copy so callers can't mutate the cached entry
+        return dict(details)
     
     except json.JSONDecodeError as e:
         print(f"JSON parsing error: {e}")
-        print(f"Text that failed to parse: '{text}'")
+        print(f"Text that failed to parse: '{e.doc}'")
         return None
     except Exception as e:
         print(f"Error extracting flight details: {e}")
@@ -184,16 +307,23 @@ def normalize_airport_code(code):
     code = code.upper().strip()
     
     # Validate it's a 3-letter code
-    if len(code) == 3 and code.isalpha():
-        return code
-    
-    return None
+    return code if _IATA_RE.match(code) else None
+
+
+def _merge_round_trip(outbound, inbound):
+    """
+    Combines two one-way results into a single round-trip result.
+    Outbound options stay in `flights`; return options are attached as `return_flights`.
+    """
+    outbound.return_flights = inbound.flights if inbound else []
+    return outbound
 
 
 async def search_flights_fastflights(departure, destination, depart_date, return_date=None, adults=1, children=0, deep_search=True):
     """
     Searches for flights using the fast_flights library with LOCAL mode.
     Supports deep search for more comprehensive results.
+    Round trips are searched as two concurrent one-way lookups.
     
     Args:
         deep_search: If True, performs multiple searches to get all available flights
@@ -205,12 +335,11 @@ async def search_flights_fastflights(departure, destination, depart_date, return
     if not departure or not destination:
         raise ValueError("Invalid airport codes provided")
     
-    flight_data = [FlightData(date=depart_date, from_airport=departure, to_airport=destination)]
-    trip_type = "one-way"
+    outbound_leg = [FlightData(date=depart_date, from_airport=departure, to_airport=destination)]
+    return_leg = None
     
     if return_date and return_date != "null":
-        flight_data.append(FlightData(date=return_date, from_airport=destination, to_airport=departure))
-        trip_type = "round-trip"
+        return_leg = [FlightData(date=return_date, from_airport=destination, to_airport=departure)]
     
     passengers = Passengers(
         adults=int(adults) if adults else 1,
@@ -220,30 +349,40 @@ async def search_flights_fastflights(departure, destination, depart_date, return
     )
     
     try:
-        loop = asyncio.get_event_loop()
+        loop = asyncio.get_running_loop()
         
-        if deep_search:
-            print("🔎 Performing DEEP SEARCH (this takes longer but finds more flights)...")
-            results = await loop.run_in_executor(
-                None,
-                _deep_search_flights,
-                flight_data,
-                trip_type,
-                "economy",
-                passengers,
-                5  # num_scrolls
-            )
-        else:
-            print("🔍 Performing standard search...")
-            results = await loop.run_in_executor(
-                None,
+        def run_leg(leg):
+            if deep_search:
+                return loop.run_in_executor(
+                    _FLIGHT_POOL,
+                    _deep_search_flights,
+                    leg,
+                    "one-way",
+                    "economy",
+                    passengers,
+                    5  # num_scrolls
+                )
+            return loop.run_in_executor(
+                _FLIGHT_POOL,
                 _get_flights_in_thread,
-                flight_data,
-                trip_type,
+                leg,
+                "one-way",
                 "economy",
                 passengers
             )
         
+        if deep_search:
+            print("🔎 Performing DEEP SEARCH (this takes longer but finds more flights)...")
+        else:
+            print("🔍 Performing standard search...")
+        
+        if return_leg:
+            # Both legs are independent one-way searches, so fetch them concurrently
+            outbound, inbound = await asyncio.gather(run_leg(outbound_leg), run_leg(return_leg))
+            return _merge_round_trip(outbound, inbound)
+        
+        results = await run_leg(outbound_leg)
+        
         return results
     
     except Exception as e:
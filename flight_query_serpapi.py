@@ -1,14 +1,30 @@
 # flight_query_serpapi.py (FIXED VERSION)
 import os
-import requests
+import logging
+import httpx
+import importlib.util
 import google.generativeai as genai
 from dotenv import load_dotenv
-from datetime import datetime
-import json
+from datetime import date, datetime
+from pathlib import Path
+import orjson
+import msgspec
+import re
 import asyncio
+import time
+import random
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from threading import Lock
+from operator import itemgetter
+from heapq import nsmallest
+from itertools import chain
+from typing import NamedTuple
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
 SERPAPI_KEY = os.environ.get('SERPAPI_KEY')
 
@@ -18,41 +34,269 @@ if not GEMINI_API_KEY:
 if not SERPAPI_KEY:
     raise ValueError("SERPAPI_KEY not found in .env. Get one at https://serpapi.com/")
 
+# httpx only imports h2 when the first HTTP/2 client is built; check here so a missing extra fails at startup
+if importlib.util.find_spec('h2') is None:
+    raise ImportError("HTTP/2 support not installed. Install it with: pip install 'httpx[http2]'")
+
+# Static instructions go in the system instruction, keeping each request's contents to just the query.
+# This is for structure only: gemini-2.0-flash gets no implicit prefix caching and the prompt is far
+# below the caching token minimum anyway.
+_EXTRACTION_INSTRUCTION = """You are a flight booking assistant. Extract flight details from the user's query and return ONLY valid JSON, nothing else.
+
+Return ONLY this JSON format (no markdown, no explanation):
+{"departure": "airport_code", "destination": "airport_code", "depart_date": "YYYY-MM-DD", "return_date": "YYYY-MM-DD or null", "adults": 1, "children": 0}
+
+Example: {"departure": "YYZ", "destination": "JFK", "depart_date": "2025-03-10", "return_date": "2025-03-15", "adults": 1, "children": 0}
+"""
+
 genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel('gemini-2.0-flash')
+model = genai.GenerativeModel('gemini-2.0-flash', system_instruction=_EXTRACTION_INSTRUCTION)
 
 SERPAPI_BASE_URL = "https://serpapi.com/search"
 
 
-def extract_flight_details(user_input):
+def _load_iata_codes():
     """
-    Uses Gemini API to extract structured flight query details from natural language input.
+    Loads the known IATA airport and metropolitan area codes shipped next to this module.
+    """
+    with open(Path(__file__).with_name('iata_codes.txt'), encoding='utf-8') as f:
+        return frozenset(line.strip() for line in f if line.strip() and not line.startswith('#'))
+
+
+_VALID_IATA = _load_iata_codes()
+
+# Only the SerpAPI fields we read; everything else in the payload is skipped by the decoder.
+# Per-flight fields accept null and loose types, so a malformed group is skipped by
+# _extract_flight_info instead of failing the decode of the whole response.
+class Airport(msgspec.Struct):
+    time: str | None = None
+
+
+class Leg(msgspec.Struct):
+    departure_airport: Airport | None = None
+    arrival_airport: Airport | None = None
+    airline: str | None = None
+
+
+class FlightGroup(msgspec.Struct):
+    flights: list[Leg] | None = None
+    price: int | float | str | None = None
+    total_duration: int | float | str | None = None
+    layovers: list | None = None
+
+
+class SerpResponse(msgspec.Struct):
+    best_flights: list[FlightGroup] = []
+    other_flights: list[FlightGroup] = []
+    price_insights: dict = {}
+    search_metadata: dict = {}
+    error: str | None = None
+
+
+class FlightInfo(NamedTuple):
+    """
+    One flight option as shown to the user.
+    """
+    airline: str
+    departure: str
+    arrival: str
+    duration: str
+    stops: int
+    price: int | float
+    price_str: str
+
+
+# Parsed results for recent searches, keyed by the normalized query tuple
+_CACHE_TTL = 600  # seconds
+_SERP_CACHE = OrderedDict()  # key -> (timestamp, parsed results), oldest first
+_SERP_CACHE_SIZE = 256
+_SERP_LOCKS = {}  # key -> (asyncio.Lock, number of tasks holding or waiting on it)
+
+# Shared across requests so concurrent searches multiplex over one HTTP/2 connection
+_client = None
+
+# Caps in-flight SerpAPI requests so fan-out stays under the plan's rate limit
+_SERP_SEM = asyncio.Semaphore(int(os.environ.get('SERPAPI_CONCURRENCY', '8')))
+
+_RETRY_STATUSES = {429, 500, 502, 503, 504}
+_RETRY_ATTEMPTS = 3
+_RETRY_BACKOFF = 0.5  # seconds, doubled after each failed attempt
+_RETRY_MAX_WAIT = 8  # seconds
+
+# Cheapest flights kept per search; the bot shows the top 5
+_MAX_RESULTS = 20
+
+
+def _get_cached_results(key):
     """
+    Returns cached parsed results for a search key, or None if missing or expired.
+    """
+    entry = _SERP_CACHE.get(key)
+    if entry is None:
+        return None
+    
+    timestamp, results = entry
+    if time.monotonic() - timestamp >= _CACHE_TTL:
+        del _SERP_CACHE[key]
+        return None
+    
+    return results
+
+
+def _cache_results(key, results):
+    """
+    Stores parsed results for a search key, sweeping expired entries and the oldest past _SERP_CACHE_SIZE.
+    """
+    now = time.monotonic()
+    _SERP_CACHE[key] = (now, results)
+    _SERP_CACHE.move_to_end(key)
+    
+    # Entries stay in insertion order, so the expired ones are always at the front
+    while _SERP_CACHE:
+        oldest_key, (timestamp, _) = next(iter(_SERP_CACHE.items()))
+        if now - timestamp < _CACHE_TTL and len(_SERP_CACHE) <= _SERP_CACHE_SIZE:
+            break
+        del _SERP_CACHE[oldest_key]
+
+
+@asynccontextmanager
+async def _search_lock(key):
+    """
+    Holds the per-key search lock. The lock is dropped once no other task holds or waits on it.
+    """
+    # The new lock is only built when no task is using this key yet
+    lock, users = _SERP_LOCKS.get(key) or (asyncio.Lock(), 0)
+    _SERP_LOCKS[key] = (lock, users + 1)
+    
     try:
-        response = model.generate_content(
-            contents=[f"""You are a flight booking assistant. Extract flight details from this query and return ONLY valid JSON, nothing else.
+        async with lock:
+            yield
+    finally:
+        lock, users = _SERP_LOCKS[key]
+        if users == 1:
+            del _SERP_LOCKS[key]
+        else:
+            _SERP_LOCKS[key] = (lock, users - 1)
 
-Query: "{user_input}"
 
-Return ONLY this JSON format (no markdown, no explanation):
-{{"departure": "airport_code", "destination": "airport_code", "depart_date": "YYYY-MM-DD", "return_date": "YYYY-MM-DD or null", "adults": 1, "children": 0}}
+async def _get_client():
+    """
+    Returns the shared httpx client, creating it on first use inside the running loop.
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        # HTTP/2 lets concurrent searches share one TLS connection; keep-alive skips repeat handshakes
+        _client = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(120.0),
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=16, keepalive_expiry=60)
+        )
+    return _client
 
-Example: {{"departure": "YYZ", "destination": "JFK", "depart_date": "2025-03-10", "return_date": "2025-03-15", "adults": 1, "children": 0}}
-"""])
 
-        text = response.text.strip()
-        text = text.replace(chr(96), "").strip()
-        if text.startswith("json"):
-            text = text[4:].strip()
-        
-        flight_data = json.loads(text)
-        return flight_data
+async def close_session():
+    """
+    Closes the shared httpx client. Call this on application shutdown.
+    """
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
+
+
+_QUERY_PUNCT_RE = re.compile(r"[^\w\s'/:>-]")
+_QUERY_SPACE_RE = re.compile(r'\s+')
+_DATE_RE = re.compile(r'([0-9]{4})-([0-9]{1,2})-([0-9]{1,2})')
+_BACKTICK_TABLE = str.maketrans('', '', '`')
+
+
+def _normalize_query(user_input):
+    """
+    Lowercases, drops punctuation and collapses whitespace so equivalent queries share a cache entry.
+    Apostrophes and date/route separators (-, /, :, >) are kept since they carry meaning.
+    Only used as the cache key; Gemini is always sent the user's original text.
+    """
+    text = _QUERY_PUNCT_RE.sub(' ', user_input.lower())
+    return _QUERY_SPACE_RE.sub(' ', text).strip()
+
+
+# Extraction results keyed by (today, normalized query). The date is part of the key because
+# relative inputs like "tomorrow" mean a different date each day.
+_EXTRACTION_CACHE = OrderedDict()
+_EXTRACTION_CACHE_SIZE = 1024
+_EXTRACTION_CACHE_LOCK = Lock()  # extraction runs in executor threads
+
+
+def _get_cached_details(key):
+    """
+    Returns cached extraction results for a key, marking them recently used, or None.
+    """
+    with _EXTRACTION_CACHE_LOCK:
+        details = _EXTRACTION_CACHE.get(key)
+        if details is not None:
+            _EXTRACTION_CACHE.move_to_end(key)
+        return details
+
+
+def _cache_details(key, details):
+    """
+    Stores extraction results, evicting the least recently used entry once the cache is full.
+    """
+    with _EXTRACTION_CACHE_LOCK:
+        _EXTRACTION_CACHE[key] = details
+        _EXTRACTION_CACHE.move_to_end(key)
+        if len(_EXTRACTION_CACHE) > _EXTRACTION_CACHE_SIZE:
+            _EXTRACTION_CACHE.popitem(last=False)
+
+
+def _extract_flight_details_uncached(user_input):
+    """
+    Calls Gemini with the user's raw query. Raises on failure so errors are never cached.
+    """
+    response = model.generate_content(contents=[f'Query: "{user_input}"'])
+
+    text = response.text
+    # Fast path: Gemini usually follows the "no markdown" instruction
+    if text.lstrip().startswith('{'):
+        return orjson.loads(text)
+    
+    # Fenced reply: drop every backtick in one C-level pass, then the optional "json" tag
+    text = text.translate(_BACKTICK_TABLE).strip()
+    if text[:4] == 'json':
+        text = text[4:]
+    return orjson.loads(text)
+
+
+def extract_flight_details(user_input):
+    """
+    Uses Gemini API to extract structured flight query details from natural language input.
+    Results are cached per day by normalized query, so repeated inputs skip the Gemini call.
+    """
+    try:
+        key = (date.today(), _normalize_query(user_input))
+        details = _get_cached_details(key)
+        if details is None:
+            # Gemini sees what the user actually typed; normalization only shapes the cache key
+            details = _extract_flight_details_uncached(user_input)
+            _cache_details(key, details)
+        # Copy so callers can't mutate the cached entry
+        return dict(details)
     
     except Exception as e:
-        print(f"Error extracting flight details: {e}")
+        logger.error("Error extracting flight details: %s", e)
         return None
 
 
+def _parse_date(value):
+    """
+    Parses a YYYY-MM-DD date (same inputs strptime's '%Y-%m-%d' accepts) without the format parser.
+    """
+    match = _DATE_RE.fullmatch(value) if isinstance(value, str) else None
+    if not match:
+        raise ValueError(f"Invalid date: {value!r}")
+    return datetime(*map(int, match.groups()))
+
+
 def validate_flight_data(flight_data):
     """
     Validates flight data and returns missing fields.
@@ -76,12 +320,12 @@ def validate_flight_data(flight_data):
         return False, missing, message
     
     try:
-        depart = datetime.strptime(flight_data['depart_date'], '%Y-%m-%d')
+        depart = _parse_date(flight_data['depart_date'])
         if depart < datetime.now():
             return False, ['depart_date'], "The departure date must be in the future."
         
         if flight_data.get('return_date') and flight_data['return_date'] != "null":
-            return_date = datetime.strptime(flight_data['return_date'], '%Y-%m-%d')
+            return_date = _parse_date(flight_data['return_date'])
             if return_date <= depart:
                 return False, ['return_date'], "The return date must be after the departure date."
     except ValueError:
@@ -93,19 +337,16 @@ def validate_flight_data(flight_data):
 def normalize_airport_code(code):
     """
     Normalizes airport codes to uppercase 3-letter IATA code.
+    Returns None unless the code is a known airport or metropolitan area code.
     """
     if not code or code == "null":
         return None
     
     code = code.upper().strip()
-    
-    if len(code) == 3 and code.isalpha():
-        return code
-    
-    return None
+    return code if code in _VALID_IATA else None
 
 
-def _search_flights_serpapi(departure, destination, depart_date, return_date=None, adults=1, children=0, deep_search=True, show_hidden=True):
+async def _search_flights_serpapi(departure, destination, depart_date, return_date=None, adults=1, children=0, deep_search=True, show_hidden=True):
     """
     Search flights using SerpAPI.
     """
@@ -130,20 +371,30 @@ def _search_flights_serpapi(departure, destination, depart_date, return_date=Non
         if return_date and return_date != "null":
             params["return_date"] = return_date
         
-        print(f"🔍 Searching SerpAPI...")
-        response = requests.get(SERPAPI_BASE_URL, params=params, timeout=120)
-        response.raise_for_status()
-        
-        return response.json()
+        logger.debug("🔍 Searching SerpAPI...")
+        client = await _get_client()
+        for attempt in range(1, _RETRY_ATTEMPTS + 1):
+            async with _SERP_SEM:
+                response = await client.get(SERPAPI_BASE_URL, params=params)
+            
+            if response.status_code not in _RETRY_STATUSES or attempt == _RETRY_ATTEMPTS:
+                response.raise_for_status()
+                return msgspec.json.decode(response.content, type=SerpResponse)
+            
+            # Rate limited or transient server error: release the slot, back off with jitter and try again
+            delay = min(_RETRY_MAX_WAIT, _RETRY_BACKOFF * 2 ** (attempt - 1) + random.uniform(0, _RETRY_BACKOFF))
+            logger.warning("SerpAPI returned %s, retrying in %.1fs (%d/%d)...", response.status_code, delay, attempt, _RETRY_ATTEMPTS)
+            await asyncio.sleep(delay)
     
     except Exception as e:
-        print(f"Error in SerpAPI search: {e}")
+        logger.error("Error in SerpAPI search: %s", e)
         raise
 
 
-def _parse_serpapi_results(api_response):
+def _parse_serpapi_results(api_response, max_results=_MAX_RESULTS):
     """
-    Parses SerpAPI response properly.
+    Parses a decoded SerpResponse into the results dict used by the bot; 'flights' holds FlightInfo tuples.
+    Keeps only the max_results cheapest flights, sorted by price.
     """
     try:
         flights_data = {
@@ -154,107 +405,99 @@ def _parse_serpapi_results(api_response):
         }
         
         # Check for errors
-        if api_response.get('search_metadata', {}).get('status') == 'Error':
-            flights_data['error'] = api_response.get('search_metadata', {}).get('error')
-            print(f"API Error: {flights_data['error']}")
+        if api_response.search_metadata.get('status') == 'Error':
+            flights_data['error'] = api_response.search_metadata.get('error') or api_response.error
+            logger.error("API Error: %s", flights_data['error'])
             return flights_data
         
         # Get price insights
-        price_insights = api_response.get('price_insights', {})
+        price_insights = api_response.price_insights
         flights_data['price_level'] = price_insights.get('price_level', 'unknown')
         flights_data['lowest_price'] = price_insights.get('lowest_price')
         
-        print(f"Price insights: lowest={flights_data['lowest_price']}, level={flights_data['price_level']}")
-        
-        # Parse best flights
-        best_flights = api_response.get('best_flights', [])
-        print(f"Found {len(best_flights)} best flights")
-        
-        for flight_group in best_flights:
-            flight_info = _extract_flight_info(flight_group)
-            if flight_info:
-                flights_data['flights'].append(flight_info)
-        
-        # Parse other flights
-        other_flights = api_response.get('other_flights', [])
-        print(f"Found {len(other_flights)} other flights")
+        logger.debug("Price insights: lowest=%s, level=%s", flights_data['lowest_price'], flights_data['price_level'])
         
-        for flight_group in other_flights:
-            flight_info = _extract_flight_info(flight_group)
-            if flight_info:
-                flights_data['flights'].append(flight_info)
+        best_flights = api_response.best_flights
+        other_flights = api_response.other_flights
+        logger.debug("Found %d best flights, %d other flights", len(best_flights), len(other_flights))
         
-        # Sort by price
-        flights_data['flights'].sort(key=lambda x: x['price'] if isinstance(x['price'], (int, float)) else float('inf'))
+        # Pick the cheapest in one pass over both groups; display fields are only built for those
+        candidates = filter(None, map(_extract_flight_info, chain(best_flights, other_flights)))
+        cheapest = nsmallest(max_results, candidates, key=itemgetter(0))
+        flights_data['flights'] = [_format_flight_info(info) for info in cheapest]
         
-        print(f"✅ Total flights: {len(flights_data['flights'])}")
+        logger.info("✅ Total flights: %d (of %d)", len(flights_data['flights']), len(best_flights) + len(other_flights))
         
         return flights_data
     
     except Exception as e:
-        print(f"Error parsing: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error parsing: %s", e)
         return {'flights': [], 'error': str(e), 'price_level': 'unknown', 'lowest_price': None}
 
 
+def _coerce_number(value):
+    """
+    Returns a numeric SerpAPI field as a number, parsing strings like "300" or "1,250".
+    None passes through; raises ValueError for anything unparseable.
+    """
+    if isinstance(value, str):
+        value = float(value.replace(',', ''))
+        return int(value) if value.is_integer() else value
+    return value
+
+
+def _airport_time(airport):
+    """
+    Returns an airport's time, or 'N/A' when SerpAPI left the airport or its time out.
+    """
+    return airport.time if airport and airport.time else 'N/A'
+
+
 def _extract_flight_info(flight_group):
     """
-    Extracts flight information from SerpAPI flight group.
-    Handles multi-leg flights (with layovers).
+    Extracts the raw fields of a SerpAPI FlightGroup as a lightweight tuple:
+    (price, airline, dep_time, arr_time, total_duration, stops).
+    Handles multi-leg flights (with layovers). Returns None for groups without legs or price,
+    or with a malformed price or duration.
     """
     try:
-        flights = flight_group.get('flights', [])
-        if not flights:
-            return None
-        
-        # Get first and last flight
-        first_flight = flights[0]
-        last_flight = flights[-1]
-        
-        # Get price
-        price = flight_group.get('price')
-        if price is None:
+        flights = flight_group.flights
+        price = _coerce_number(flight_group.price)
+        if not flights or price is None:
             return None
         
-        # Format departure time (from first flight)
-        dep_time = first_flight.get('departure_airport', {}).get('time', 'N/A')
-        
-        # Format arrival time (from last flight)
-        arr_time = last_flight.get('arrival_airport', {}).get('time', 'N/A')
-        
-        # Format duration
-        total_duration = flight_group.get('total_duration', 0)
-        hours = total_duration // 60
-        minutes = total_duration % 60
-        duration_str = f"{hours}h {minutes}m"
-        
-        # Count stops (layovers)
-        layovers = flight_group.get('layovers', [])
-        stops = len(layovers)
-        
-        # Get airline (for multi-airline, show first)
-        airline = first_flight.get('airline', 'Unknown')
-        
-        flight_info = {
-            'airline': airline,
-            'departure': dep_time,
-            'arrival': arr_time,
-            'duration': duration_str,
-            'stops': stops,
-            'price': price,
-            'price_str': f"${price}",
-        }
-        
-        print(f"  ✓ {airline} - ${price} ({duration_str}, {stops} stops)")
-        
-        return flight_info
+        # Departure from the first leg, arrival from the last; for multi-airline, show first airline
+        return (
+            price,
+            flights[0].airline or 'Unknown',
+            _airport_time(flights[0].departure_airport),
+            _airport_time(flights[-1].arrival_airport),
+            int(_coerce_number(flight_group.total_duration) or 0),
+            len(flight_group.layovers or ())
+        )
     
     except Exception as e:
-        print(f"Error extracting flight: {e}")
+        logger.error("Error extracting flight: %s", e)
         return None
 
 
+def _format_flight_info(info):
+    """
+    Builds the FlightInfo shown to the user from a tuple returned by _extract_flight_info.
+    """
+    price, airline, dep_time, arr_time, total_duration, stops = info
+    
+    hours = total_duration // 60
+    minutes = total_duration % 60
+    duration_str = f"{hours}h {minutes}m"
+    
+    # Runs once per shown flight, so skip formatting entirely unless debugging
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("  ✓ %s - $%s (%s, %d stops)", airline, price, duration_str, stops)
+    
+    return FlightInfo(airline, dep_time, arr_time, duration_str, stops, price, f"${price}")
+
+
 async def search_flights_serpapi(departure, destination, depart_date, return_date=None, adults=1, children=0, deep_search=True, show_hidden=True):
     """
     Search for flights using SerpAPI.
@@ -265,28 +508,38 @@ async def search_flights_serpapi(departure, destination, depart_date, return_dat
     if not departure or not destination:
         raise ValueError("Invalid airport codes provided")
     
-    try:
-        print(f"🔎 Searching SerpAPI (deep_search={deep_search}, show_hidden={show_hidden})...")
+    return_date = return_date if return_date and return_date != "null" else None
+    adults = int(adults) if adults else 1
+    children = int(children) if children else 0
+    
+    key = (departure, destination, depart_date, return_date, adults, children, deep_search, show_hidden)
+    
+    # Identical concurrent searches wait on the same lock, so only the first one hits SerpAPI
+    async with _search_lock(key):
+        cached = _get_cached_results(key)
+        if cached is not None:
+            logger.info("✅ Serving SerpAPI results from cache")
+            return cached
         
-        loop = asyncio.get_event_loop()
-        api_response = await loop.run_in_executor(
-            None,
-            _search_flights_serpapi,
-            departure,
-            destination,
-            depart_date,
-            return_date,
-            adults,
-            children,
-            deep_search,
-            show_hidden
-        )
+        try:
+            logger.info("🔎 Searching SerpAPI (deep_search=%s, show_hidden=%s)...", deep_search, show_hidden)
+            
+            api_response = await _search_flights_serpapi(
+                departure,
+                destination,
+                depart_date,
+                return_date,
+                adults,
+                children,
+                deep_search,
+                show_hidden
+            )
+            
+            parsed_results = _parse_serpapi_results(api_response)
+            if not parsed_results.get('error'):
+                _cache_results(key, parsed_results)
+            return parsed_results
         
-        parsed_results = _parse_serpapi_results(api_response)
-        return parsed_results
-    
-    except Exception as e:
-        print(f"Error fetching flights: {e}")
-        import traceback
-        traceback.print_exc()
-        raise
+        except Exception as e:
+            logger.exception("Error fetching flights: %s", e)
+            raise
@@ -0,0 +1,51 @@
+def format_flight_results(results, flight_data):
+    """
+    Formats SerpAPI flight results (FlightInfo entries) into a readable message.
+    """
+    if results.get('error'):
+        return (
+            f"❌ API Error: {results['error']}\n\n"
+            "This might be a temporary issue. Please try again."
+        )
+    
+    if not results or not results.get('flights') or len(results['flights']) == 0:
+        return (
+            "😔 No flights found for your search.\n\n"
+            f"Route: {flight_data['departure']} → {flight_data['destination']}\n"
+            f"Dates: {flight_data['depart_date']}"
+            f"{' → ' + flight_data.get('return_date', '') if flight_data.get('return_date') else ' (one-way)'}\n\n"
+            "Try different dates or airports."
+        )
+    
+    available_flights = results['flights'][:5]
+    
+    trip_type = "Round-trip" if flight_data.get('return_date') else "One-way"
+    parts = [
+        f"✈️ *{trip_type} Flights Found*\n\n",
+        f"📍 {flight_data['departure']} → {flight_data['destination']}\n",
+        f"📅 {flight_data['depart_date']}"
+    ]
+    
+    if flight_data.get('return_date'):
+        parts.append(f" → {flight_data['return_date']}")
+    
+    parts.append(f"\n👥 {flight_data.get('adults', 1)} adult(s)")
+    if flight_data.get('children', 0) > 0:
+        parts.append(f", {flight_data['children']} child(ren)")
+    
+    parts.append("\n\n📊 *Top 5 Cheapest Options:*\n\n")
+    
+    for idx, flight in enumerate(available_flights, 1):
+        parts.append(
+            f"{idx}. *{flight.price_str}* - {flight.airline}\n"
+            f"   ⏰ {flight.departure} → {flight.arrival}\n"
+            f"   ⏱ Duration: {flight.duration}\n"
+            f"   🛫 Stops: {flight.stops}\n\n"
+        )
+    
+    parts.append(f"💡 Price level: {results.get('price_level', 'unknown')}\n")
+    if results.get('lowest_price'):
+        parts.append(f"💰 Lowest price: ${results['lowest_price']}\n")
+    parts.append("_Want to search again? Just send me another request!_")
+    
+    return "".join(parts)